@@ -3,21 +3,23 @@ from app.log import logger
 from app.plugins import _PluginBase
 from app.core.event import eventmanager
 from app.schemas.types import EventType
-from app.utils.system import SystemUtils
-from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.cron import CronTrigger
-from app.chain.media import MediaChain
-from app.core.metainfo import MetaInfo
 from app.core.config import settings
 from app import schemas
-from app.schemas.types import MediaType, EventType, SystemConfigKey
 from datetime import datetime
 
 from typing import Any, List, Dict, Tuple, Optional
-import subprocess
 import os
+import re
+import stat
 import threading
-from app.plugins.danmu import danmu_generator as generator
+import time
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor
+
+# 需要刮削弹幕的视频扩展名
+_VIDEO_EXTS = frozenset({'.mp4', '.mkv'})
+# 从 MetaInfo 的集数字符串（如 E01、E01-E02）中提取首集集数
+_EPISODE_RE = re.compile(r'[Ee](\d{1,4})')
 
 
 class Danmuziyong(_PluginBase):
@@ -30,7 +32,7 @@ class Danmuziyong(_PluginBase):
     # 主题色
     plugin_color = "#3B5E8E"
     # 插件版本
-    plugin_version = "1.0.1"
+    plugin_version = "1.0.2"
     # 插件作者
     plugin_author = "edhnt455"
     # 作者主页
@@ -52,14 +54,42 @@ class Danmuziyong(_PluginBase):
     _alpha = 0.8
     _duration = 6
     _cron = '0 0 1 1 *'
+    _cron_trigger = None
     _path = ''
     _max_threads = 10
     _onlyFromBili = False
     _useTmdbID = True
-
-    media_chain = MediaChain()
+    _forceRescrape = False
+    # 解析后的刮削路径
+    _paths = ()
+    # 监控路径的绝对路径前缀，以路径分隔符结尾
+    _monitor_paths = ()
+    # 监控路径的绝对路径，用于匹配配置为单个文件的路径
+    _monitor_files = frozenset()
+
+    # 媒体识别链，首次使用时再创建
+    _media_chain = None
+    # 媒体识别结果缓存，同一剧集的各集只识别一次
+    _recognize_cache: Optional[Dict[str, dict]] = None
+    _recognize_ttl = 7 * 24 * 3600
+    _recognize_lock = threading.Lock()
+    # 缓存是否有未保存的识别结果
+    _recognize_dirty = False
+    # 正在识别的缓存键，同一剧集的其他线程等待识别结果
+    _recognizing: Optional[Dict[str, threading.Event]] = None
+    # 弹幕生成线程池，全局刮削与事件触发共用
+    _executor: Optional[ThreadPoolExecutor] = None
+    _executor_lock = threading.Lock()
+    # 停止服务时递增，之前发起的刮削与提交随之失效
+    _generation = 0
+    # 已提交且未完成的文件，避免重复生成
+    _inflight: Optional[set] = None
+    _inflight_lock = threading.Lock()
 
     def init_plugin(self, config: dict = None):
+        # 可变容器按实例创建，避免挂在类上被多个实例共享，识别缓存在 __load_recognize_cache 中创建
+        self._recognizing = {}
+        self._inflight = set()
         if config:
             self._enabled = config.get("enabled", False)
             self._width = config.get("width", 1920)
@@ -72,12 +102,104 @@ class Danmuziyong(_PluginBase):
             self._cron = config.get("cron", "0 0 1 1 *")
             self._onlyFromBili = config.get("onlyFromBili", False)
             self._useTmdbID = config.get("useTmdbID", True)
+            self._forceRescrape = config.get("forceRescrape", False)
+            try:
+                self._max_threads = max(1, int(config.get("max_threads") or 10))
+            except (TypeError, ValueError):
+                self._max_threads = 10
+
+        # 停止现有任务
+        self.stop_service()
+
+        self.__parse_paths()
+        self.__load_recognize_cache()
+        try:
+            self._cron_trigger = CronTrigger.from_crontab(self._cron) if self._cron else None
+        except ValueError as e:
+            self._cron_trigger = None
+            logger.error(f"定时刮削周期格式错误: {self._cron}, {e}")
         if self._enabled:
             logger.info("弹幕加载插件已启用")
 
     def get_state(self) -> bool:
         return self._enabled
 
+    def __submit_task(self, generation: int, fn, *args) -> Optional[Future]:
+        """
+        向弹幕生成线程池提交任务，线程池不存在时创建
+        持锁提交，避免与 stop_service 关闭线程池交错
+        :param generation: 发起提交时的服务代次，服务已停止时不再提交
+        :return: 任务Future，服务已停止时返回None
+        """
+        with self._executor_lock:
+            if generation != self._generation:
+                return None
+            if not self._executor:
+                from app.plugins.danmuziyong.danmu_generator import POOL_MAXSIZE
+                # 线程数超过连接池大小只会阻塞等待连接
+                self._executor = ThreadPoolExecutor(max_workers=min(self._max_threads, POOL_MAXSIZE),
+                                                    thread_name_prefix="danmu")
+            return self._executor.submit(fn, *args)
+
+    def __load_recognize_cache(self):
+        """
+        加载持久化的媒体识别缓存，丢弃已过期的记录
+        """
+        now = time.time()
+        cache = self.get_data("recognize_cache") or {}
+        with self._recognize_lock:
+            self._recognize_cache = {key: value for key, value in cache.items()
+                                     if now - value.get("time", 0) < self._recognize_ttl}
+            self._recognize_dirty = False
+
+    def __save_recognize_cache(self):
+        """
+        保存媒体识别缓存，同时丢弃已过期的记录，没有新的识别结果时不保存
+        """
+        now = time.time()
+        with self._recognize_lock:
+            if not self._recognize_dirty:
+                return
+            self._recognize_cache = {key: value for key, value in self._recognize_cache.items()
+                                     if now - value.get("time", 0) < self._recognize_ttl}
+            self._recognize_dirty = False
+            cache = dict(self._recognize_cache)
+        self.save_data("recognize_cache", cache)
+
+    def __parse_paths(self):
+        """
+        解析刮削路径配置，监控路径末尾补充分隔符避免 /media/tv2 误匹配 /media/tv
+        """
+        self._paths = tuple(os.path.normpath(p.strip()) for p in (self._path or '').split('\n') if p.strip())
+        self._monitor_files = frozenset(os.path.abspath(p) for p in self._paths)
+        self._monitor_paths = tuple(os.path.join(p, '') for p in self._monitor_files)
+
+    def __is_monitored(self, file_path: str) -> bool:
+        """
+        判断文件是否在刮削路径下，或本身即为配置的单个文件
+        """
+        file_path = os.path.abspath(file_path)
+        return file_path in self._monitor_files or file_path.startswith(self._monitor_paths)
+
+    @staticmethod
+    def __iter_video_files(root: str):
+        """
+        遍历目录下的视频文件，使用 os.scandir 复用目录项自带的文件类型信息
+        """
+        stack = [root]
+        while stack:
+            current = stack.pop()
+            try:
+                with os.scandir(current) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        elif entry.is_file() \
+                                and os.path.splitext(entry.name)[1].lower() in _VIDEO_EXTS:
+                            yield entry.path
+            except OSError as e:
+                logger.warning(f"读取目录失败: {current}, {e}")
+
     def get_service(self) -> List[Dict[str, Any]]:
         """
         注册插件公共服务
@@ -90,11 +212,11 @@ class Danmuziyong(_PluginBase):
         }]
         """
         return []
-        if self.get_state() and self._path and self._cron:
+        if self.get_state() and self._path and self._cron_trigger:
             return [{
                 "id": "Danmu2",
                 "name": "弹幕全局刮削服务(自用)",
-                "trigger": CronTrigger.from_crontab(self._cron),
+                "trigger": self._cron_trigger,
                 "func": self.generate_danmu_global,
                 "kwargs": {}
             }]
@@ -133,6 +255,7 @@ class Danmuziyong(_PluginBase):
         """
         拼装插件配置页面，需要返回两块数据：1、页面配置；2、数据结构
         """
+        from app.plugins.danmuziyong.danmu_generator import POOL_MAXSIZE
         return [
             {
                 'component': 'VForm',
@@ -192,6 +315,22 @@ class Danmuziyong(_PluginBase):
                                         }
                                     }
                                 ]
+                            },
+                            {
+                                'component': 'VCol',
+                                'props': {
+                                    'cols': 12,
+                                    'md': 6
+                                },
+                                'content': [
+                                    {
+                                        'component': 'VSwitch',
+                                        'props': {
+                                            'model': 'forceRescrape',
+                                            'label': '全局刮削时重新生成已有弹幕文件',
+                                        }
+                                    }
+                                ]
                             }
                         ]
                     },
@@ -293,6 +432,23 @@ class Danmuziyong(_PluginBase):
                                     }
                                 ]
                             },
+                            {
+                                'component': 'VCol',
+                                'props': {
+                                    'cols': 6,
+                                },
+                                'content': [
+                                    {
+                                        'component': 'VTextField',
+                                        'props': {
+                                            'model': 'max_threads',
+                                            'label': f'最大刮削线程数，默认10，最大{POOL_MAXSIZE}，网络较慢或被限制时请调低',
+                                            'type': 'number',
+
+                                        }
+                                    }
+                                ]
+                            },
                             # {
                             #     'component': 'VCol',
                             #     'props': {
@@ -385,10 +541,12 @@ class Danmuziyong(_PluginBase):
             "fontsize": 50,
             "alpha": 0.8,
             "duration": 6,
+            "max_threads": 10,
             "cron": "0 0 1 1 *",
             "path": "",
             "onlyFromBili": False,
-            "useTmdbID": True
+            "useTmdbID": True,
+            "forceRescrape": False
         }
 
     def get_page(self) -> List[dict]:
@@ -528,23 +686,36 @@ class Danmuziyong(_PluginBase):
             }
         ]
 
-    def generate_danmu(self, file_path: str) -> Optional[str]:
+    def generate_danmu(self, file_path: str, force: bool = False) -> Optional[str]:
         """
         生成弹幕文件
         :param file_path: 视频文件路径
+        :param force: 是否忽略已存在的弹幕文件强制重新生成
         :return: 生成的弹幕文件路径，如果失败则返回None
         """
-        meta = MetaInfo(file_path)
+        if not force:
+            danmu_file = self.__get_existing_danmu(file_path)
+            if danmu_file:
+                logger.debug(f"弹幕文件已存在，跳过生成: {danmu_file}")
+                return danmu_file
+
+        # 延迟导入，插件未使用时不加载识别和弹幕生成模块
+        from app.plugins.danmuziyong import danmu_generator as generator
+
         tmdb_id = None
         episode = None
         release_date = None
         use_short_cache_ttl = False
         if self._useTmdbID:
-            media_info = self.media_chain.recognize_media(meta=meta)
+            # 仅在使用TMDB ID匹配时解析文件名
+            from app.core.metainfo import MetaInfo
+            meta = MetaInfo(file_path)
+            media_info = self.__recognize_media(meta)
             if media_info:
-                tmdb_id = media_info.tmdb_id
-                episode = meta.episode.split('E')[1] if meta.episode else None
-                release_date = media_info.release_date
+                tmdb_id = media_info.get("tmdb_id")
+                episode_match = _EPISODE_RE.search(meta.episode) if meta.episode else None
+                episode = int(episode_match.group(1)) if episode_match else None
+                release_date = media_info.get("release_date")
                 # 检查发布日期是否在最近90天内
                 if release_date:
                     try:
@@ -575,11 +746,71 @@ class Danmuziyong(_PluginBase):
             logger.error(f"生成弹幕失败: {e}")
             return None
 
+    @staticmethod
+    def __get_existing_danmu(file_path: str) -> Optional[str]:
+        """
+        获取已生成且不早于视频文件的弹幕文件
+        """
+        danmu_file = os.path.splitext(file_path)[0] + '.danmu.ass'
+        try:
+            if os.path.getmtime(danmu_file) >= os.path.getmtime(file_path):
+                return danmu_file
+        except OSError:
+            pass
+        return None
+
+    def __recognize_media(self, meta) -> Optional[Dict[str, Any]]:
+        """
+        识别媒体信息，按名称、年份、类型、季缓存识别结果，缓存有效期7天并持久化保存
+        :return: {"tmdb_id": TMDB ID, "release_date": 发布日期}，识别失败返回None
+        """
+        media_type = meta.type.value if meta.type else ""
+        cache_key = f"{meta.name}|{meta.year}|{media_type}|{meta.begin_season}"
+        with self._recognize_lock:
+            cached = self._recognize_cache.get(cache_key)
+            if cached and time.time() - cached.get("time", 0) < self._recognize_ttl:
+                return cached
+            # 同一剧集已有线程在识别时等待其结果，不重复识别
+            event = self._recognizing.get(cache_key)
+            if not event:
+                owner = self._recognizing[cache_key] = threading.Event()
+        if event:
+            event.wait()
+            with self._recognize_lock:
+                return self._recognize_cache.get(cache_key)
+
+        try:
+            if not self._media_chain:
+                from app.chain.media import MediaChain
+                with self._recognize_lock:
+                    if not self._media_chain:
+                        self._media_chain = MediaChain()
+            media_info = self._media_chain.recognize_media(meta=meta)
+            if not media_info:
+                return None
+
+            result = {
+                "tmdb_id": media_info.tmdb_id,
+                "release_date": media_info.release_date,
+                "time": time.time()
+            }
+            # 识别结果在刮削结束或事件任务完成后统一保存
+            with self._recognize_lock:
+                self._recognize_cache[cache_key] = result
+                self._recognize_dirty = True
+            return result
+        finally:
+            with self._recognize_lock:
+                if self._recognizing.get(cache_key) is owner:
+                    del self._recognizing[cache_key]
+            owner.set()
+
     def update_path(self, path: str):
         """
         更新路径
         """
         self._path = path
+        self.__parse_paths()
         logger.info(f"更新路径: {self._path}")
 
     def generate_danmu_global(self):
@@ -591,52 +822,69 @@ class Danmuziyong(_PluginBase):
             return schemas.Response(success=False, message="没有设定路径")
 
         logger.info("开始弹幕刮削")
-        threading_list = []
-        paths = [path.strip() for path in self._path.split('\n') if path.strip()]
-
-        for path in paths:
-            if not os.path.exists(path):
+        generation = self._generation
+        futures = []
+        skipped = 0
+        # 限制排队任务数量，避免遍历大目录时一次性堆积过多任务
+        semaphore = threading.BoundedSemaphore(self._max_threads * 2)
+
+        def __submit(_file: str):
+            nonlocal skipped
+            # 已有弹幕的文件不再提交，避免占用线程
+            if not self._forceRescrape and self.__get_existing_danmu(_file):
+                logger.debug(f"弹幕文件已存在，跳过生成: {_file}")
+                skipped += 1
+                return
+            logger.debug(f"开始生成弹幕文件：{_file}")
+            semaphore.acquire()
+            try:
+                future = self.__submit_danmu(_file, self._forceRescrape, generation)
+            except Exception:
+                semaphore.release()
+                raise
+            if not future:
+                semaphore.release()
+                return
+            future.add_done_callback(lambda _: semaphore.release())
+            futures.append(future)
+
+        for path in self._paths:
+            if generation != self._generation:
+                break
+            try:
+                path_stat = os.stat(path)
+            except OSError:
                 logger.warning(f"路径不存在: {path}")
                 return schemas.Response(success=False, message=f"路径不存在: {path}")
-                continue
 
             # 检查是否是单个文件
-            if os.path.isfile(path) and path.endswith(('.mp4', '.mkv')):
+            if stat.S_ISREG(path_stat.st_mode) and os.path.splitext(path)[1].lower() in _VIDEO_EXTS:
                 logger.info(f"刮削单个文件：{path}")
-                if len(threading_list) >= self._max_threads:
-                    threading_list[0].join()
-                    threading_list.pop(0)
-
-                thread = threading.Thread(
-                    target=self.generate_danmu,
-                    args=(path,)
-                )
-                thread.start()
-                threading_list.append(thread)
+                __submit(path)
                 continue
 
             # 处理目录
             logger.info(f"刮削路径：{path}")
-            for root, _, files in os.walk(path):
-                for file in files:
-                    if file.endswith(('.mp4', '.mkv')):
-                        if len(threading_list) >= self._max_threads:
-                            threading_list[0].join()
-                            threading_list.pop(0)
-
-                        target_file = os.path.join(root, file)
-                        logger.info(f"开始生成弹幕文件：{target_file}")
-                        thread = threading.Thread(
-                            target=self.generate_danmu,
-                            args=(target_file,)
-                        )
-                        thread.start()
-                        threading_list.append(thread)
-
-        for thread in threading_list:
-            thread.join()
-
-        logger.info("弹幕刮削完成")
+            for target_file in self.__iter_video_files(path):
+                if generation != self._generation:
+                    break
+                __submit(target_file)
+
+        # 服务停止时排队中的任务被取消，wait() 不会将其视为完成，逐个等待结果
+        cancelled = 0
+        for future in futures:
+            try:
+                future.result()
+            except CancelledError:
+                cancelled += 1
+            except Exception as e:
+                logger.error(f"生成弹幕失败: {e}")
+        self.__save_recognize_cache()
+
+        if generation != self._generation:
+            logger.info(f"插件已停止，弹幕刮削中止，已处理{len(futures) - cancelled}个文件")
+            return schemas.Response(success=False, message="弹幕刮削已中止")
+        logger.info(f"弹幕刮削完成，处理{len(futures)}个文件，跳过已有弹幕{skipped}个")
         return schemas.Response(success=True, message="弹幕刮削完成 ")
 
     @eventmanager.register(EventType.TransferComplete)
@@ -651,53 +899,32 @@ class Danmuziyong(_PluginBase):
             logger.warning("未设置刮削路径，跳过弹幕生成")
             return
 
-        def __to_dict(_event):
+        def __get_field(_obj, _name: str):
             """
-            递归将对象转换为字典
+            读取对象属性或字典键
             """
-            if isinstance(_event, dict):
-                return {k: __to_dict(v) for k, v in _event.items()}
-            elif isinstance(_event, list):
-                return [__to_dict(item) for item in _event]
-            elif isinstance(_event, tuple):
-                return tuple(__to_dict(list(_event)))
-            elif isinstance(_event, set):
-                return set(__to_dict(list(_event)))
-            elif hasattr(_event, 'to_dict'):
-                return __to_dict(_event.to_dict())
-            elif hasattr(_event, '__dict__'):
-                return __to_dict(_event.__dict__)
-            elif isinstance(_event, (int, float, str, bool, type(None))):
-                return _event
-            else:
-                return str(_event)
+            if isinstance(_obj, dict):
+                return _obj.get(_name)
+            return getattr(_obj, _name, None)
 
         try:
-            raw_data = __to_dict(event.event_data)
-            target_file = raw_data.get("transferinfo", {}).get("file_list_new", [None])[0]
+            transferinfo = __get_field(event.event_data, "transferinfo")
+            file_list = __get_field(transferinfo, "file_list_new")
+            target_file = str(file_list[0]) if file_list and file_list[0] else None
 
             if not target_file:
                 logger.warning("未找到目标文件")
                 return
 
             # 检查文件是否在刮削路径下
-            is_monitored = False
-            monitor_paths = [path.strip() for path in self._path.split('\n') if path.strip()]
-            for monitor_path in monitor_paths:
-                if os.path.abspath(target_file).startswith(os.path.abspath(monitor_path)):
-                    is_monitored = True
-                    break
-
-            if not is_monitored:
+            if not self.__is_monitored(target_file):
                 logger.info(f"文件不在刮削路径下，跳过弹幕生成: {target_file}")
                 return
 
             logger.info(f"开始生成弹幕文件：{target_file}")
-            thread = threading.Thread(
-                target=self.generate_danmu,
-                args=(target_file,)
-            )
-            thread.start()
+            future = self.__submit_danmu(target_file, True)
+            if future:
+                future.add_done_callback(lambda _: self.__save_recognize_cache())
         except Exception as e:
             logger.error(f"处理传输完成事件失败: {e}")
 
@@ -705,7 +932,15 @@ class Danmuziyong(_PluginBase):
         """
         退出插件
         """
-        pass
+        try:
+            self.__save_recognize_cache()
+            with self._executor_lock:
+                self._generation += 1
+                if self._executor:
+                    self._executor.shutdown(wait=False, cancel_futures=True)
+                    self._executor = None
+        except Exception as e:
+            logger.info(str(e))
 
     @eventmanager.register(EventType.WebhookMessage)
     def handle_emby_webhook(self, event):
@@ -730,27 +965,51 @@ class Danmuziyong(_PluginBase):
             media_type = event_data.media_type
             media_path = event_data.item_path
 
-            # 检查文件是否在监控路径下
-            is_monitored = False
-            monitor_paths = [path.strip() for path in self._path.split('\n') if path.strip()]
-            for monitor_path in monitor_paths:
-                if os.path.abspath(media_path).startswith(os.path.abspath(monitor_path)):
-                    is_monitored = True
-                    break
-
-            if not is_monitored:
+            # 先检查文件类型，再检查路径
+            if not media_path or os.path.splitext(media_path)[1].lower() not in _VIDEO_EXTS:
                 return
 
-            # 检查文件类型
-            if not media_path.lower().endswith(('.mp4', '.mkv')):
+            # 检查文件是否在监控路径下
+            if not self.__is_monitored(media_path):
                 return
 
-            logger.info(f"检测到新文件，开始生成弹幕: {media_path}")
-            thread = threading.Thread(
-                target=self.generate_danmu,
-                args=(media_path,)
-            )
-            thread.start()
+            logger.info(f"检测到新文件，提交弹幕生成任务: {media_path}")
+            future = self.__submit_danmu(media_path, True)
+            if future:
+                future.add_done_callback(lambda _: self.__save_recognize_cache())
 
         except Exception as e:
             logger.error(f"处理Emby webhook事件失败: {e}")
+
+    def __submit_danmu(self, file_path: str, force: bool = False,
+                       generation: Optional[int] = None) -> Optional[Future]:
+        """
+        提交弹幕生成任务，已在处理中的文件不重复提交
+        :param file_path: 视频文件路径
+        :param force: 是否强制重新生成
+        :param generation: 发起提交时的服务代次，默认为当前代次
+        :return: 任务Future，文件已在处理中或服务已停止时返回None
+        """
+        if generation is None:
+            generation = self._generation
+        with self._inflight_lock:
+            if file_path in self._inflight:
+                return None
+            self._inflight.add(file_path)
+        try:
+            future = self.__submit_task(generation, self.generate_danmu, file_path, force)
+        except Exception:
+            self.__release_inflight(file_path)
+            raise
+        if not future:
+            self.__release_inflight(file_path)
+            return None
+        future.add_done_callback(lambda _: self.__release_inflight(file_path))
+        return future
+
+    def __release_inflight(self, file_path: str):
+        """
+        移除已结束的文件
+        """
+        with self._inflight_lock:
+            self._inflight.discard(file_path)
@@ -1,14 +1,27 @@
 import chardet
 import requests
+from requests.adapters import HTTPAdapter
 import os
 import re
 import hashlib
 import subprocess
 import json
+import threading
+import time
 from typing import Optional, Dict, List, Tuple
 from dataclasses import dataclass
 from app.log import logger
 
+try:
+    import orjson
+    # 弹幕列表动辄上万条，优先使用更快的 orjson 解析
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+# 弹幕服务器连接池大小，刮削线程数不应超过此值
+POOL_MAXSIZE = 32
+
 
 @dataclass
 class VideoInfo:
@@ -19,21 +32,62 @@ class VideoInfo:
     match_mode: str = "hashAndFileName"
 
 
+class TokenBucket:
+    """
+    令牌桶限流，多个刮削线程共享，避免请求过快被弹幕服务器限制
+    """
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait_time = (1 - self._tokens) / self.rate
+            time.sleep(wait_time)
+
+
 class DanmuAPI:
     BASE_URL = 'https://dandanapi.hankun.online/api/v1'
     HEADERS = {
         'Accept': 'application/json',
         "User-Agent": "Moviepilot/plugins 1.3.0"
     }
+    # 所有请求共用一个会话，复用到弹幕服务器的 TCP/TLS 连接
+    SESSION = requests.Session()
+    SESSION.headers.update(HEADERS)
+    # 连接池需容纳所有刮削线程的并发请求，默认的10个连接不足时会反复新建连接
+    SESSION.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=POOL_MAXSIZE))
+    SESSION.mount('http://', HTTPAdapter(pool_connections=4, pool_maxsize=POOL_MAXSIZE))
+    # 请求超时(连接, 读取)秒数，避免卡住的请求长期占用共享线程池
+    TIMEOUT = (10, 30)
+    # 每秒最多5个请求
+    LIMITER = TokenBucket(rate=5, capacity=5)
 
     @staticmethod
     def calculate_md5_of_first_16MB(file_path: str) -> str:
         md5 = hashlib.md5()
-        size_16MB = 16 * 1024 * 1024
+        remaining = 16 * 1024 * 1024
+        # 分块读取，避免多线程刮削时每个线程各自占用16MB内存
+        chunk_size = 1024 * 1024
         try:
             with open(file_path, 'rb') as f:
-                data = f.read(size_16MB)
-                md5.update(data)
+                while remaining > 0:
+                    data = f.read(min(chunk_size, remaining))
+                    if not data:
+                        break
+                    md5.update(data)
+                    remaining -= len(data)
             return md5.hexdigest()
         except Exception as e:
             logger.error(f"计算MD5失败: {e}")
@@ -85,9 +139,10 @@ class DanmuAPI:
                 data["episode"] = episode
             else:
                 data["episode"] = 1
-            response = requests.post(url, json=data, headers=DanmuAPI.HEADERS)
+            DanmuAPI.LIMITER.acquire()
+            response = DanmuAPI.SESSION.post(url, json=data, timeout=DanmuAPI.TIMEOUT)
             if response.status_code == 200:
-                result = response.json()
+                result = _json_loads(response.content)
                 if result.get("success") and not result.get("hasMore"):
                     animes = result.get("animes", [])
                     if animes and len(animes) > 0:
@@ -134,10 +189,11 @@ class DanmuAPI:
 
             # 使用 match API
             url = f"{DanmuAPI.BASE_URL}/match"
-            response = requests.post(url, json=video_info.__dict__, headers=DanmuAPI.HEADERS)
+            DanmuAPI.LIMITER.acquire()
+            response = DanmuAPI.SESSION.post(url, json=video_info.__dict__, timeout=DanmuAPI.TIMEOUT)
 
             if response.status_code == 200:
-                result = response.json()
+                result = _json_loads(response.content)
                 if result.get("isMatched") and result.get("matches"):
                     return str(result["matches"][0]["episodeId"])
 
@@ -177,9 +233,10 @@ class DanmuAPI:
         """
         try:
             url = f"{cls.BASE_URL}/{comment_id}?from_id=0&with_related=true&ch_convert=1"
-            response = requests.get(url, headers=cls.HEADERS)
+            cls.LIMITER.acquire()
+            response = cls.SESSION.get(url, timeout=cls.TIMEOUT)
             if response.status_code == 200:
-                return response.json()
+                return _json_loads(response.content)
             logger.error(f"获取弹幕失败: {response.text}")
             return None
         except Exception as e:
@@ -357,7 +414,8 @@ Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
 
         logger.info(f"{output_file} - 共匹配到{len(comments)}条弹幕。")
 
-        with open(output_file, 'w', encoding='utf-8-sig') as f:
+        # 逐行写入弹幕，使用较大的写缓冲减少系统调用
+        with open(output_file, 'w', encoding='utf-8-sig', buffering=1 << 20) as f:
             cls.write_ass_head(f, width, height, fontface, fontsize, alpha, styleid)
 
             for comment in comments:
@@ -429,7 +487,7 @@ class SubtitleProcessor:
                 stderr=subprocess.PIPE,
                 universal_newlines=True
             )
-            return json.loads(result.stdout) if result.returncode == 0 else {}
+            return _json_loads(result.stdout) if result.returncode == 0 else {}
         except Exception as e:
             logger.error(f"获取视频流信息失败: {e}")
             return {}
@@ -525,7 +583,7 @@ class SubtitleProcessor:
                 events_content = sub2_content[events_start + len('[Events]'):].strip()
                 output = os.path.splitext(sub2)[0] + ".withDanmu.ass"
 
-                with open(output, 'w', encoding='utf-8-sig') as f:
+                with open(output, 'w', encoding='utf-8-sig', buffering=1 << 20) as f:
                     f.write(sub1_content)
                     f.write('\n[V4+ Styles]\n')
                     f.write(format_match.group())
@@ -558,7 +616,8 @@ def danmu_generator(file_path: str, width: int = 1920, height: int = 1080,
         if not comments_data:
             return None
 
-        comments = sorted(comments_data["comments"], key=lambda x: float(x['p'].split(',')[0]))
+        # 按时间排序在 filter_comments 中统一完成
+        comments = comments_data["comments"]
 
         if len(comments) == 0:
             logger.info(f"弹幕数量为0，跳过生成 - {file_path}")